@@ -7,22 +7,36 @@ Pick up the work seamlessly in the Antigravity IDE.
 
 import asyncio
 import difflib
+import errno
+import functools
+import hashlib
 import html
+import io
 import json
 import logging
 import os
-import subprocess
+import re
+import shutil
+import signal
+import stat
 import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime
+from typing import Any
 
 from google import genai
 from google.genai import types
 from telegram import Update
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
     CommandHandler,
     ContextTypes,
     MessageHandler,
+    TypeHandler,
     filters,
 )
 
@@ -45,7 +59,7 @@ from config import (
 # ── Logging ──────────────────────────────────────────────────────────────────
 logging.basicConfig(
     format="%(asctime)s [%(levelname)s] %(message)s",
-    level=logging.INFO,
+    level=os.environ.get("LOG_LEVEL", "INFO").upper(),
 )
 logger = logging.getLogger(__name__)
 
@@ -56,221 +70,617 @@ chat_config = types.GenerateContentConfig(
     system_instruction=SYSTEM_PROMPT,
 )
 
+# Gemini calls can block for many seconds; their own pool keeps a burst of
+# them from tying up the threads that file reads and session saves run on
+_gemini_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="anti-bot-gemini")
+
 # ── Session State ────────────────────────────────────────────────────────────
-active_chat = None
-conversation_history: list[dict] = []
-action_log: list[dict] = []  # Rich action log for continuity
-session_start_time: str = ""
-current_project_dir: str = PROJECT_DIR
+DIFF_EDIT_THRESHOLD = 8_000  # Files larger than this are edited via a diff
+_chat_locks: defaultdict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+_APPROVE = frozenset({"✅", "yes", "y", "approve"})
+_REJECT = frozenset({"❌", "no", "n", "reject", "cancel"})
+
+# Turns are buffered and flushed to disk every AUTO_SAVE_INTERVAL
+AUTO_SAVE_INTERVAL = 5
+
+# Rendered-Markdown cache: transcript digest → session .md it was rendered to
+_RENDER_CACHE_SIZE = 16
+_render_cache: dict[str, str] = {}
+
+
+@dataclass
+class Session:
+    """One chat's Gemini conversation and everything logged during it."""
+    chat: Any
+    session_id: str  # Names the session's files; unique per chat and start
+    start_time: str
+    project_dir: str = PROJECT_DIR
+    history: list[dict] = field(default_factory=list)
+    action_log: list[dict] = field(default_factory=list)  # Rich action log for continuity
+    user_msg_count: int = 0  # Running counts for /history
+    action_count: int = 0
+    pending_action: dict = None  # Stores action waiting for ✅/❌
+
+    # Auto-save state
+    unsaved_turns: list[dict] = field(default_factory=list)
+    turns_since_save: int = 0
+    save_pending: bool = False
+    dirty: bool = False  # Set when turns were recorded during the current handler
+    transcript_hash: Any = field(default_factory=hashlib.blake2b)
+
+    gemini_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    save_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
 
-# Pending approval state
-pending_action: dict = None  # Stores action waiting for ✅/❌
+
+_sessions: dict[int, Session] = {}  # chat_id → its current session
+_save_tasks: set[asyncio.Task] = set()  # Background saves, held until they finish
 
 
 def _ensure_sessions_dir():
     os.makedirs(SESSIONS_DIR, exist_ok=True)
 
 
-def _start_new_session():
-    global active_chat, conversation_history, action_log, session_start_time
-    conversation_history = []
-    action_log = []
-    session_start_time = datetime.now().strftime("%Y-%m-%d_%H%M")
-    active_chat = client.chats.create(
-        model=GEMINI_MODEL,
-        config=chat_config,
+def _new_session(chat_id: int, project_dir: str = PROJECT_DIR) -> Session:
+    start_time = datetime.now().strftime("%Y-%m-%d_%H%M%S")
+    sess = Session(
+        chat=client.chats.create(
+            model=GEMINI_MODEL,
+            config=chat_config,
+        ),
+        session_id=f"{start_time}_{chat_id}",
+        start_time=start_time,
+        project_dir=project_dir,
     )
-    logger.info(f"New session started: {session_start_time}")
+    logger.info("New session started: %s", sess.session_id)
+    return sess
+
 
+def _session_for(update: Update) -> Session:
+    """Return the chat's session, starting one on first use."""
+    chat_id = update.effective_chat.id
+    sess = _sessions.get(chat_id)
+    if sess is None:
+        sess = _sessions[chat_id] = _new_session(chat_id)
+    return sess
 
-def _log_action(action_type: str, details: dict):
+
+def _log_action(sess: Session, action_type: str, details: dict):
     """Log an action for continuity with the IDE."""
-    action_log.append({
+    sess.action_log.append({
         "type": action_type,
         "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         **details,
     })
-    _save_session()
 
 
-def _resolve_path(path: str) -> str:
-    """Resolve a path relative to the current project directory."""
-    path = os.path.expanduser(os.path.expandvars(path.strip()))
+def _resolve_path(path: str, base_dir: str) -> str:
+    """Resolve a path relative to the project directory ``base_dir``."""
+    path = path.strip()
+    # Most paths have neither; skip the expansion scans for them
+    if "$" in path:
+        path = os.path.expandvars(path)
+    if "~" in path:
+        path = os.path.expanduser(path)
     if not os.path.isabs(path):
-        path = os.path.join(current_project_dir, path)
+        path = os.path.join(base_dir, path)
     return os.path.normpath(path)
 
 
-# ── Session Saving (Rich Action Log) ────────────────────────────────────────
-def _save_session():
-    if not conversation_history and not action_log:
+# ── Session Saving (Append-only Transcript) ─────────────────────────────────
+_ACTION_ICONS = {
+    "FILE_VIEW": "📂", "FILE_EDIT": "✏️", "FILE_CREATE": "🆕",
+    "DIR_LIST": "📁", "COMMAND_RUN": "⚡", "TASK_EXECUTE": "🚀",
+    "PROJECT_SET": "📍",
+}
+
+
+def _session_path(sess: Session, suffix: str) -> str:
+    return os.path.join(SESSIONS_DIR, f"session_{sess.session_id}{suffix}")
+
+
+def _append_turn(sess: Session, msg: dict):
+    """Record a message and buffer it for the session's JSONL transcript."""
+    sess.history.append(msg)
+    if msg["role"] == "user":
+        sess.user_msg_count += 1
+    if msg.get("action"):
+        sess.action_count += 1
+    sess.unsaved_turns.append(msg)
+    sess.turns_since_save += 1
+    sess.transcript_hash.update(f"{msg['role']}{msg['text']}\n".encode())
+    sess.dirty = True
+
+
+def _flush_if_dirty(sess: Session):
+    """Schedule a save if this handler recorded turns and the interval is due."""
+    if not sess.dirty:
         return
+    sess.dirty = False
+    if sess.turns_since_save >= AUTO_SAVE_INTERVAL:
+        _schedule_save(sess)
+
+
+def with_autosave(handler):
+    """Run ``_flush_if_dirty`` once after a handler, however many turns it logged."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        try:
+            return await handler(update, context)
+        finally:
+            sess = _sessions.get(update.effective_chat.id)
+            if sess is not None:
+                _flush_if_dirty(sess)
+    return wrapper
+
+
+def _schedule_save(sess: Session):
+    """Start a background save, unless one is already waiting to run."""
+    if sess.save_pending:
+        return
+    sess.save_pending = True
+    task = asyncio.get_running_loop().create_task(_save_session(sess))
+    _save_tasks.add(task)
+    task.add_done_callback(_save_tasks.discard)
+
+
+async def _save_session(sess: Session) -> str:
+    """Flush buffered turns and metadata to disk off the event loop."""
+    async with sess.save_lock:
+        return await _flush_turns(sess)
+
+
+async def _save_and_render(sess: Session):
+    """Flush the session, then render its Markdown.
+
+    The save lock is held across both, so no background save appends to the
+    transcript while it's being read and renders of one session never overlap.
+    """
+    async with sess.save_lock:
+        digest = await _flush_turns(sess)
+        await asyncio.to_thread(_render_markdown, sess, digest)
+
+
+async def _flush_turns(sess: Session) -> str:
+    """Write buffered turns and metadata; the caller holds ``sess.save_lock``.
+
+    Returns the transcript digest as of the flushed turns, for
+    ``_render_markdown`` to key its cache on, or None if the write failed.
+    Turns stay buffered until they are on disk, so a failed save is retried.
+    """
+    sess.save_pending = False
+    # Taken with the turns, so later appends can't leak into the snapshot
+    digest = sess.transcript_hash.hexdigest()
+    if not sess.unsaved_turns:
+        return digest
+    turns = list(sess.unsaved_turns)
+    meta = {
+        "session_id": sess.session_id,
+        "start_time": sess.start_time,
+        "last_activity": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "project_dir": sess.project_dir,
+        "msg_count": len(sess.history),
+    }
+    try:
+        await asyncio.to_thread(
+            _save_session_sync,
+            _session_path(sess, ".jsonl"), _session_path(sess, ".meta.json"), turns, meta,
+        )
+    except Exception as e:
+        logger.error("Session save failed for %s: %s", sess.session_id, e)
+        return None
+    # Turns appended during the write stay buffered for the next save
+    del sess.unsaved_turns[:len(turns)]
+    sess.turns_since_save = len(sess.unsaved_turns)
+    return digest
+
 
+def _save_session_sync(transcript_file: str, meta_file: str, turns: list[dict], meta: dict):
     _ensure_sessions_dir()
-    timestamp = session_start_time or datetime.now().strftime("%Y-%m-%d_%H%M")
-
-    lines = [
-        f"# Telegram Session — {timestamp}",
-        "",
-        "> anti-bot action log. To continue in Antigravity IDE, reference this file.",
-        f"> Project directory: `{current_project_dir}`",
-        "",
-        "---",
-        "",
-    ]
-
-    for msg in conversation_history:
-        role = msg["role"]
-        text = msg["text"]
-        action = msg.get("action")
-
-        if role == "user":
-            lines.append("## 👤 You")
-            lines.append("")
-            lines.append(text)
-            lines.append("")
-        elif role == "model":
-            lines.append("## 🤖 anti-bot")
-            lines.append("")
-            lines.append(text)
-            lines.append("")
-
-        if action:
-            atype = action["type"]
-            icon = {"FILE_VIEW": "📂", "FILE_EDIT": "✏️", "FILE_CREATE": "🆕",
-                    "DIR_LIST": "📁", "COMMAND_RUN": "⚡", "TASK_EXECUTE": "🚀",
-                    "PROJECT_SET": "📍"}.get(atype, "📌")
-
-            lines.append(f"## {icon} ACTION: {atype}")
-            for k, v in action.items():
-                if k in ("type", "timestamp"):
-                    continue
-                if k == "diff":
-                    lines.append(f"**Diff:**")
-                    lines.append("```diff")
-                    lines.append(str(v))
-                    lines.append("```")
-                elif k == "output":
-                    lines.append(f"**Output:**")
-                    lines.append("```")
-                    lines.append(str(v)[:2000])
-                    lines.append("```")
-                elif k == "content_preview":
-                    lines.append(f"**Preview:**")
-                    lines.append("```")
-                    lines.append(str(v)[:2000])
-                    lines.append("```")
-                else:
-                    lines.append(f"**{k.replace('_', ' ').title()}:** `{v}`")
-            lines.append("")
+    lines = "".join(json.dumps(msg, ensure_ascii=False) + "\n" for msg in turns)
 
-    content = "\n".join(lines)
+    # Write-then-rename so the metadata file is never half-written
+    tmp_file = meta_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, meta_file)
 
-    session_file = os.path.join(SESSIONS_DIR, f"session_{timestamp}.md")
-    with open(session_file, "w") as f:
-        f.write(content)
+    # Appended last: if anything above fails, retrying can't duplicate turns
+    with open(transcript_file, "a") as f:
+        f.write(lines)
 
-    latest_file = os.path.join(SESSIONS_DIR, "latest.md")
-    with open(latest_file, "w") as f:
-        f.write(content)
 
-    logger.info(f"Session saved to {session_file}")
+def _render_markdown(sess: Session, digest: str):
+    """Render the session's JSONL transcript to Markdown for the IDE to pick up.
+
+    ``digest`` is the one ``_save_session`` returned for the flush this
+    render follows; if it's None the save failed and nothing is cached.
+    """
+    transcript_file = _session_path(sess, ".jsonl")
+    if not os.path.exists(transcript_file):
+        return
+
+    session_file = _session_path(sess, ".md")
+
+    # Nothing appended since the last render — the files are already current
+    if digest is not None and _render_cache.get(digest) == session_file \
+            and os.path.exists(session_file):
+        return
+
+    tmp_file = _unique_tmp(session_file)
+
+    try:
+        # Stream straight to disk — the full Markdown is never held in memory
+        with open(transcript_file) as transcript, \
+                open(tmp_file, "x", buffering=1 << 16) as out:
+            out.write(
+                f"# Telegram Session — {sess.start_time}\n"
+                "\n"
+                "> anti-bot action log. To continue in Antigravity IDE, reference this file.\n"
+                f"> Project directory: `{sess.project_dir}`\n"
+                "\n"
+                "---\n"
+                "\n"
+            )
+
+            for raw in transcript:
+                if not raw.strip():
+                    continue
+                msg = json.loads(raw)
+                role = msg["role"]
+                text = msg["text"]
+                action = msg.get("action")
+
+                if role == "user":
+                    out.write(f"## 👤 You\n\n{text}\n\n")
+                elif role == "model":
+                    out.write(f"## 🤖 anti-bot\n\n{text}\n\n")
+
+                if action:
+                    atype = action["type"]
+                    icon = _ACTION_ICONS.get(atype, "📌")
+
+                    out.write(f"## {icon} ACTION: {atype}\n")
+                    for k, v in action.items():
+                        if k in ("type", "timestamp"):
+                            continue
+                        if k == "diff":
+                            out.write(f"**Diff:**\n```diff\n{v}\n```\n")
+                        elif k == "output":
+                            out.write(f"**Output:**\n```\n{str(v)[:2000]}\n```\n")
+                        elif k == "content_preview":
+                            out.write(f"**Preview:**\n```\n{str(v)[:2000]}\n```\n")
+                        else:
+                            out.write(f"**{k.replace('_', ' ').title()}:** `{v}`\n")
+                    out.write("\n")
+
+        # Rename into place so a crash never leaves a half-written file
+        os.replace(tmp_file, session_file)
+    except BaseException:
+        # Don't leave a partial render behind under its one-off name
+        if os.path.exists(tmp_file):
+            os.unlink(tmp_file)
+        raise
+
+    _publish_latest(session_file)
+
+    if digest is not None:
+        _render_cache[digest] = session_file
+    while len(_render_cache) > _RENDER_CACHE_SIZE:
+        del _render_cache[next(iter(_render_cache))]
+
+    logger.info("Session rendered to %s", session_file)
+
+
+def _unique_tmp(path: str) -> str:
+    """A temp name next to ``path`` that no other writer or crash leftover shares."""
+    return f"{path}.{os.urandom(8).hex()}.tmp"
+
+
+# Errors meaning the filesystem can't hard-link this file, rather than a real failure
+_NO_LINK_ERRNOS = frozenset({
+    errno.EPERM, errno.EXDEV, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP,
+})
+
+
+def _publish_latest(session_file: str):
+    """Atomically point latest.md at ``session_file``.
+
+    latest.md is a hard link to the same data; where links aren't supported
+    the Markdown is copied into a freshly created file instead. Temp names
+    are unique, so a stale one left by a crash is never written through.
+    """
+    latest_file = os.path.join(SESSIONS_DIR, "latest.md")
+    latest_tmp = _unique_tmp(latest_file)
+    try:
+        os.link(session_file, latest_tmp)
+    except OSError as e:
+        if e.errno not in _NO_LINK_ERRNOS:
+            raise
+        with open(session_file, "rb") as src, open(latest_tmp, "xb") as out:
+            shutil.copyfileobj(src, out)
+    try:
+        os.replace(latest_tmp, latest_file)
+    except OSError:
+        os.unlink(latest_tmp)
+        raise
 
 
 # ── Security ─────────────────────────────────────────────────────────────────
+# Parsed once so each update is a plain int comparison. A value that isn't
+# a number can't match any chat id, so nobody is authorized.
+try:
+    _ALLOWED_CHAT_ID_INT = int(ALLOWED_CHAT_ID)
+except (TypeError, ValueError):
+    _ALLOWED_CHAT_ID_INT = None
+
+
 def is_authorized(update: Update) -> bool:
-    chat_id = str(update.effective_chat.id)
-    if chat_id != str(ALLOWED_CHAT_ID):
-        logger.warning(f"Unauthorized access attempt from chat_id={chat_id}")
+    chat_id = update.effective_chat.id
+    if chat_id != _ALLOWED_CHAT_ID_INT:
+        logger.warning("Unauthorized access attempt from chat_id=%s", chat_id)
         return False
     return True
 
 
-def is_blocked(command: str) -> bool:
-    cmd_lower = command.strip().lower()
-    for blocked in BLOCKED_COMMANDS:
-        if blocked.lower() in cmd_lower:
-            return True
-    return False
+# One alternation over the whole blocklist, compiled once at import
+_BLOCKED_RE = (
+    re.compile("|".join(re.escape(b.lower()) for b in BLOCKED_COMMANDS))
+    if BLOCKED_COMMANDS else None
+)
 
 
-# ── Gemini Chat ──────────────────────────────────────────────────────────────
-async def _ask_gemini(prompt: str, action: dict = None) -> str:
-    """Send a prompt to Gemini and return the response."""
-    global active_chat
+async def _reject_unauthorized(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Stop updates from other chats before any command handler is scheduled."""
+    if update.effective_chat is None or not is_authorized(update):
+        raise ApplicationHandlerStop
 
-    if not session_start_time or active_chat is None:
-        _start_new_session()
 
-    conversation_history.append({"role": "user", "text": prompt, "action": action})
+def is_blocked(command: str) -> bool:
+    if _BLOCKED_RE is None:
+        return False
+    return _BLOCKED_RE.search(command.strip().lower()) is not None
 
+
+def require_args(usage: str):
+    """Pass the handler its joined arguments, or reply with ``usage`` if there are none."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+            if not context.args:
+                await _reply(update, f"⚠️ Usage: `{usage}`")
+                return
+            return await handler(update, context, " ".join(context.args))
+        return wrapper
+    return decorator
+
+
+# ── Gemini Chat ──────────────────────────────────────────────────────────────
+async def _ask_gemini(sess: Session, prompt: str, action: dict = None) -> str:
+    """Send a prompt to the session's Gemini chat and return the response."""
     try:
-        response = active_chat.send_message(prompt)
+        # The SDK call is blocking; run it in a thread. The lock keeps
+        # concurrent handlers from interleaving turns in the chat.
+        async with sess.gemini_lock:
+            response = await asyncio.get_running_loop().run_in_executor(
+                _gemini_pool, sess.chat.send_message, prompt,
+            )
         reply = response.text
-        conversation_history.append({"role": "model", "text": reply})
-        _save_session()
+        _append_turn(sess, {"role": "user", "text": prompt, "action": action})
+        _append_turn(sess, {"role": "model", "text": reply})
         return reply
     except Exception as e:
-        logger.error(f"Gemini API error: {e}")
-        conversation_history.pop()
+        logger.error("Gemini API error: %s", e)
         return f"❌ Gemini API error: `{e}`"
 
 
+# ── Telegram Rate Limiting ───────────────────────────────────────────────────
+class AsyncTokenBucket:
+    """Token bucket that paces outgoing messages under Telegram's flood limit."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """Wait until a token is available, then take it."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+# Telegram allows ~30 messages/second per bot; stay just under it
+_send_bucket = AsyncTokenBucket(rate=28, capacity=30)
+
+
 # ── Telegram Reply Helper ────────────────────────────────────────────────────
+_MD_MARK_RE = re.compile(r"\\[_*`\[]|```|[_*`\[]")
+
+
+def _markdown_ok(text: str) -> bool:
+    """Whether Telegram's legacy Markdown parser will accept ``text``.
+
+    Follows the parser's rules: ``_``, ``*`` and backticks are closed by the
+    same mark with everything between them literal, and ``[`` needs a ``]``.
+    """
+    pos = 0
+    while True:
+        m = _MD_MARK_RE.search(text, pos)
+        if m is None:
+            return True
+        mark = m.group()
+        if mark.startswith("\\"):
+            pos = m.end()
+            continue
+        close = "]" if mark == "[" else mark
+        end = text.find(close, m.end())
+        if end == -1:
+            return False
+        pos = end + len(close)
+        if mark == "[" and text.startswith("(", pos):
+            end = text.find(")", pos)
+            if end == -1:
+                return False
+            pos = end + 1
+
+
+async def _send(update: Update, text: str, parse_mode: str = "Markdown"):
+    """Send one message, retrying without formatting if parsing fails."""
+    # Text Telegram would reject goes out plain, without a failed request first
+    if parse_mode == "Markdown" and not _markdown_ok(text):
+        parse_mode = None
+    await _send_bucket.acquire()
+    try:
+        await update.message.reply_text(text, parse_mode=parse_mode)
+    except Exception:
+        await _send_bucket.acquire()
+        await update.message.reply_text(text)
+
+
+_FENCE = "```"
+
+
+def _split_lines(lines: list[str], limit: int) -> list[str]:
+    """Pack lines into chunks, closing and reopening code fences at each cut."""
+    chunks = []
+    current = []
+    size = 0
+    opener = None  # Fence line still open at the end of `current`
+    step = limit // 2
+    for line in lines:
+        # Overlong lines are cut so a piece always fits with a fence around it
+        pieces = [line[i : i + step] for i in range(0, len(line), step)] or [""]
+        for j, piece in enumerate(pieces):
+            # Only a line's first piece can be a fence; the rest continue it
+            toggles = j == 0 and piece.strip().startswith(_FENCE)
+            # Leave room for a closing fence if one is open after this piece
+            open_after = (opener is None) if toggles else (opener is not None)
+            closing = len(_FENCE) + 1 if open_after else 0
+            glue = j > 0  # Same line as the previous piece: no newline between
+            if current and size + (0 if glue else 1) + len(piece) + closing > limit:
+                if opener:
+                    current.append(_FENCE)
+                chunks.append("\n".join(current))
+                current = [opener] if opener else []
+                size = len(opener) if opener else 0
+                glue = False
+            if glue:
+                current[-1] += piece
+                size += len(piece)
+            else:
+                size += len(piece) + (1 if current else 0)
+                current.append(piece)
+            if toggles:
+                opener = None if opener else piece.strip()
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def _split_markdown(text: str, limit: int = 4096) -> list[str]:
+    """Split text into chunks of at most ``limit`` characters.
+
+    Cuts prefer paragraph breaks outside code blocks; a paragraph or code
+    block too large for one message is split by lines, with its fence
+    closed and reopened across the cut so each chunk renders on its own.
+    """
+    if len(text) <= limit:
+        return [text]
+
+    # A blank line outside a code fence ends a paragraph
+    paragraphs = []
+    para = []
+    in_fence = False
+    for line in text.split("\n"):
+        para.append(line)
+        if line.strip().startswith(_FENCE):
+            in_fence = not in_fence
+        elif not line.strip() and not in_fence:
+            paragraphs.append(para)
+            para = []
+    if para:
+        paragraphs.append(para)
+
+    chunks = []
+    current = []
+    size = 0
+    for para in paragraphs:
+        block = "\n".join(para)
+        if len(block) > limit:
+            if current:
+                chunks.append("\n".join(current))
+                current, size = [], 0
+            chunks.extend(_split_lines(para, limit))
+            continue
+        extra = len(block) + (1 if current else 0)
+        if current and size + extra > limit:
+            chunks.append("\n".join(current))
+            current, size = [], 0
+            extra = len(block)
+        current.append(block)
+        size += extra
+    if current:
+        chunks.append("\n".join(current))
+
+    # Telegram rejects empty messages
+    return [c for c in chunks if c.strip()]
+
+
 async def _reply(update: Update, text: str, parse_mode: str = "Markdown"):
     """Send a reply, chunking if needed, with fallback for parse errors."""
-    if len(text) <= 4096:
-        try:
-            await update.message.reply_text(text, parse_mode=parse_mode)
-        except Exception:
-            await update.message.reply_text(text)
-    else:
-        for i in range(0, len(text), 4096):
-            chunk = text[i : i + 4096]
-            try:
-                await update.message.reply_text(chunk, parse_mode=parse_mode)
-            except Exception:
-                await update.message.reply_text(chunk)
+    # Sent in order — concurrent sends could arrive out of sequence
+    for chunk in _split_markdown(text):
+        await _send(update, chunk, parse_mode)
 
 
 # ── Command Handlers — AI Chat ──────────────────────────────────────────────
+_START_TEXT = (
+    "🤖 *anti-bot — Antigravity Bridge v2*\n\n"
+    "💬 *AI Chat:*\n"
+    "  Just type anything → Gemini responds\n"
+    "  `/ask <prompt>` — explicit query\n"
+    "  `/clear` — fresh session\n"
+    "  `/history` — session summary\n\n"
+    "📂 *File Operations:*\n"
+    "  `/view <path>` — read a file\n"
+    "  `/edit <path> <instructions>` — AI-powered edit\n"
+    "  `/create <path> <description>` — generate a file\n"
+    "  `/ls [path]` — list directory\n"
+    "  `/project [path]` — set working dir\n\n"
+    "🚀 *Agentic Tasks:*\n"
+    "  `/task <description>` — multi-step coding task\n\n"
+    "🖥 *Mac Control:*\n"
+    "  `/run <cmd>` — shell command\n"
+    "  `/file <path>` — download file\n"
+    "  `/screen` — screenshot\n"
+    "  `/status` — health check\n\n"
+    "📝 All actions logged for IDE continuity."
+)
+
+
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not is_authorized(update):
-        return
-    await _reply(update,
-        "🤖 *anti-bot — Antigravity Bridge v2*\n\n"
-        "💬 *AI Chat:*\n"
-        "  Just type anything → Gemini responds\n"
-        "  `/ask <prompt>` — explicit query\n"
-        "  `/clear` — fresh session\n"
-        "  `/history` — session summary\n\n"
-        "📂 *File Operations:*\n"
-        "  `/view <path>` — read a file\n"
-        "  `/edit <path> <instructions>` — AI-powered edit\n"
-        "  `/create <path> <description>` — generate a file\n"
-        "  `/ls [path]` — list directory\n"
-        "  `/project [path]` — set working dir\n\n"
-        "🚀 *Agentic Tasks:*\n"
-        "  `/task <description>` — multi-step coding task\n\n"
-        "🖥 *Mac Control:*\n"
-        "  `/run <cmd>` — shell command\n"
-        "  `/file <path>` — download file\n"
-        "  `/screen` — screenshot\n"
-        "  `/status` — health check\n\n"
-        "📝 All actions logged for IDE continuity."
-    )
+    await _reply(update, _START_TEXT)
 
 
-async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not is_authorized(update):
-        return
-    await cmd_start(update, context)
+# /help shows the same text; alias instead of delegating through another frame
+cmd_help = cmd_start
 
 
 async def cmd_clear(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not is_authorized(update):
-        return
-    _start_new_session()
+    chat_id = update.effective_chat.id
+    sess = _session_for(update)
+    await _save_and_render(sess)
+    _sessions[chat_id] = _new_session(chat_id, sess.project_dir)
     await _reply(update,
         "🗑 Session cleared. Starting fresh.\n"
         "Previous sessions are saved in `sessions/`."
@@ -278,141 +688,122 @@ async def cmd_clear(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 
 async def cmd_history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not is_authorized(update):
-        return
-
-    if not conversation_history:
+    sess = _session_for(update)
+    if not sess.history:
         await _reply(update, "📭 No conversation yet. Just type something!")
         return
 
-    msg_count = len([m for m in conversation_history if m["role"] == "user"])
-    action_count = len([m for m in conversation_history if m.get("action")])
+    await _save_and_render(sess)
+
     await _reply(update,
-        f"📝 *Session:* `{session_start_time}`\n"
-        f"💬 {msg_count} messages\n"
-        f"📌 {action_count} actions logged\n"
-        f"📁 Project: `{current_project_dir}`\n\n"
-        f"Session saved to:\n`sessions/session_{session_start_time}.md`"
+        f"📝 *Session:* `{sess.start_time}`\n"
+        f"💬 {sess.user_msg_count} messages\n"
+        f"📌 {sess.action_count} actions logged\n"
+        f"📁 Project: `{sess.project_dir}`\n\n"
+        f"Session saved to:\n`sessions/session_{sess.session_id}.md`"
     )
 
 
-async def cmd_ask(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not is_authorized(update):
-        return
-    prompt = " ".join(context.args) if context.args else ""
-    if not prompt:
-        await _reply(update, "⚠️ Usage: `/ask <your question>`")
-        return
+@with_autosave
+@require_args("/ask <your question>")
+async def cmd_ask(update: Update, context: ContextTypes.DEFAULT_TYPE, prompt: str) -> None:
     await _handle_ai_message(update, prompt)
 
 
+@with_autosave
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle plain text — check for approval or treat as AI conversation."""
-    if not is_authorized(update):
-        return
-
     text = update.message.text.strip()
     if not text:
         return
 
-    global pending_action
+    sess = _session_for(update)
 
     # Check if this is an approval response
-    if pending_action and text in ("✅", "yes", "y", "approve"):
-        await _execute_pending_action(update)
-        return
-    elif pending_action and text in ("❌", "no", "n", "reject", "cancel"):
-        action_type = pending_action.get("type", "unknown")
-        pending_action = None
-        await _reply(update, f"🚫 {action_type} cancelled.")
-        return
+    if sess.pending_action:
+        answer = text.lower()
+        if answer in _APPROVE:
+            await _execute_pending_action(update)
+            return
+        if answer in _REJECT:
+            action_type = sess.pending_action.get("type", "unknown")
+            sess.pending_action = None
+            await _reply(update, f"🚫 {action_type} cancelled.")
+            return
 
     await _handle_ai_message(update, text)
 
 
 async def _handle_ai_message(update: Update, prompt: str) -> None:
-    await _reply(update, "🧠 Thinking...")
-    reply = await _ask_gemini(prompt)
-    await _reply(update, reply)
+    # Updates are handled concurrently; keep each chat's exchanges in order
+    async with _chat_locks[update.effective_chat.id]:
+        await _reply(update, "🧠 Thinking...")
+        reply = await _ask_gemini(_session_for(update), prompt)
+        await _reply(update, reply)
 
 
 # ── File Operations ──────────────────────────────────────────────────────────
+@with_autosave
 async def cmd_project(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle /project [path] — set or show working directory."""
-    if not is_authorized(update):
-        return
-
-    global current_project_dir
+    sess = _session_for(update)
 
     if not context.args:
-        await _reply(update, f"📁 Current project: `{current_project_dir}`")
+        await _reply(update, f"📁 Current project: `{sess.project_dir}`")
         return
 
-    path = _resolve_path(" ".join(context.args))
+    path = _resolve_path(" ".join(context.args), sess.project_dir)
 
     if not os.path.isdir(path):
         await _reply(update, f"❌ Not a directory: `{path}`")
         return
 
-    current_project_dir = path
-    _log_action("PROJECT_SET", {"path": path})
-    conversation_history.append({
+    sess.project_dir = path
+    _log_action(sess, "PROJECT_SET", {"path": path})
+    _append_turn(sess, {
         "role": "user", "text": f"/project {path}",
         "action": {"type": "PROJECT_SET", "path": path},
     })
-    _save_session()
     await _reply(update, f"📍 Project set to: `{path}`")
 
 
 async def cmd_ls(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle /ls [path] — list directory contents."""
-    if not is_authorized(update):
-        return
-
-    path = _resolve_path(" ".join(context.args)) if context.args else current_project_dir
+    sess = _session_for(update)
+    path = _resolve_path(" ".join(context.args), sess.project_dir) if context.args else sess.project_dir
 
     if not os.path.isdir(path):
         await _reply(update, f"❌ Not a directory: `{path}`")
         return
 
     try:
-        entries = sorted(os.listdir(path))
+        # scandir caches each entry's type from the directory read
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda e: e.name)
         # Format with icons
         lines = [f"📁 `{path}`\n"]
         for entry in entries[:50]:  # Limit to 50 entries
-            full = os.path.join(path, entry)
-            if os.path.isdir(full):
-                lines.append(f"  📂 {entry}/")
+            if entry.is_dir():
+                lines.append(f"  📂 {entry.name}/")
             else:
-                size = os.path.getsize(full)
-                if size < 1024:
-                    sz = f"{size}B"
-                elif size < 1024 * 1024:
-                    sz = f"{size // 1024}KB"
-                else:
-                    sz = f"{size // (1024 * 1024)}MB"
-                lines.append(f"  📄 {entry} ({sz})")
+                lines.append(f"  📄 {entry.name} ({_fmt_size(entry.stat().st_size)})")
 
         if len(entries) > 50:
             lines.append(f"\n... and {len(entries) - 50} more")
 
         result = "\n".join(lines)
-        _log_action("DIR_LIST", {"path": path, "count": len(entries)})
+        _log_action(sess, "DIR_LIST", {"path": path, "count": len(entries)})
         await _reply(update, result, parse_mode=None)
     except PermissionError:
         await _reply(update, f"❌ Permission denied: `{path}`")
 
 
-async def cmd_view(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+@with_autosave
+@require_args("/view <path>")
+async def cmd_view(update: Update, context: ContextTypes.DEFAULT_TYPE, path: str) -> None:
     """Handle /view <path> — read and display a file."""
-    if not is_authorized(update):
-        return
-
-    if not context.args:
-        await _reply(update, "⚠️ Usage: `/view <path>`")
-        return
-
-    path = _resolve_path(" ".join(context.args))
+    sess = _session_for(update)
+    path = _resolve_path(path, sess.project_dir)
 
     if not os.path.exists(path):
         await _reply(update, f"❌ File not found: `{path}`")
@@ -431,39 +822,44 @@ async def cmd_view(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     try:
-        with open(path, "r") as f:
-            content = f.read()
+        content = await asyncio.to_thread(_read_file, path)
 
-        # Add line numbers
-        lines = content.split("\n")
-        numbered = "\n".join(f"{i + 1:4d} │ {line}" for i, line in enumerate(lines))
+        line_count = content.count("\n") + 1
 
-        action = {"type": "FILE_VIEW", "file": path, "lines": len(lines)}
-        _log_action("FILE_VIEW", {"file": path, "lines": len(lines)})
-        conversation_history.append({
+        action = {"type": "FILE_VIEW", "file": path, "lines": line_count}
+        _log_action(sess, "FILE_VIEW", {"file": path, "lines": line_count})
+        _append_turn(sess, {
             "role": "user", "text": f"/view {path}",
             "action": action,
         })
-        _save_session()
 
-        header = f"📄 `{path}` ({len(lines)} lines)\n\n"
-        await _reply(update, header + f"```\n{numbered}\n```")
+        # Build the numbered listing in one buffer, without splitting first
+        buf = io.StringIO()
+        buf.write(f"📄 `{path}` ({line_count} lines)\n\n```\n")
+        start = 0
+        for i in range(1, line_count + 1):
+            end = content.find("\n", start)
+            if end == -1:
+                end = len(content)
+            buf.write(f"{i:4d} │ {content[start:end]}\n")
+            start = end + 1
+        buf.write("```")
+        await _reply(update, buf.getvalue())
     except UnicodeDecodeError:
         await _reply(update, "❌ Binary file — can't display. Use `/file` to download.")
     except Exception as e:
         await _reply(update, f"❌ Error reading file: `{e}`")
 
 
+@with_autosave
 async def cmd_edit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle /edit <path> <instructions> — AI-powered file edit."""
-    if not is_authorized(update):
-        return
-
     if not context.args or len(context.args) < 2:
         await _reply(update, "⚠️ Usage: `/edit <path> <edit instructions>`")
         return
 
-    path = _resolve_path(context.args[0])
+    sess = _session_for(update)
+    path = _resolve_path(context.args[0], sess.project_dir)
     instructions = " ".join(context.args[1:])
 
     if not os.path.exists(path):
@@ -476,38 +872,55 @@ async def cmd_edit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     try:
-        with open(path, "r") as f:
-            original = f.read()
+        original = await asyncio.to_thread(_read_file, path)
     except UnicodeDecodeError:
         await _reply(update, "❌ Binary file — can't edit.")
         return
 
     await _reply(update, f"🧠 Reading `{os.path.basename(path)}` and applying edits...")
 
-    # Ask Gemini to edit the file
-    edit_prompt = (
-        f"I need you to edit the following file based on these instructions.\n\n"
-        f"**File:** `{path}`\n"
-        f"**Instructions:** {instructions}\n\n"
-        f"**Current file contents:**\n```\n{original}\n```\n\n"
-        f"Return ONLY the complete updated file contents, with no explanation "
-        f"or markdown code fences. Just the raw file content."
-    )
+    new_content = None
+
+    # For large files, ask for a diff instead of the whole file back
+    if len(original) > DIFF_EDIT_THRESHOLD:
+        diff_prompt = (
+            f"I need you to edit the following file based on these instructions.\n\n"
+            f"**File:** `{path}`\n"
+            f"**Instructions:** {instructions}\n\n"
+            f"**Current file contents:**\n```\n{original}\n```\n\n"
+            f"Return ONLY a unified diff of your changes (`@@ -l,s +l,s @@` hunks "
+            f"with 3 lines of unchanged context), with no explanation or markdown "
+            f"code fences."
+        )
+        patch = _strip_code_fences(await _ask_gemini(sess, diff_prompt))
+        new_content = _apply_unified_diff(original, patch)
+        if new_content is None:
+            logger.info("Diff edit did not apply to %s, retrying with full file", path)
+
+    if new_content is None:
+        # Ask Gemini to edit the file
+        edit_prompt = (
+            f"I need you to edit the following file based on these instructions.\n\n"
+            f"**File:** `{path}`\n"
+            f"**Instructions:** {instructions}\n\n"
+            f"**Current file contents:**\n```\n{original}\n```\n\n"
+            f"Return ONLY the complete updated file contents, with no explanation "
+            f"or markdown code fences. Just the raw file content."
+        )
 
-    new_content = await _ask_gemini(edit_prompt)
+        new_content = await _ask_gemini(sess, edit_prompt)
 
-    # Clean up — Gemini sometimes wraps in code fences
-    new_content = _strip_code_fences(new_content)
+        # Clean up — Gemini sometimes wraps in code fences
+        new_content = _strip_code_fences(new_content)
 
-    # Generate diff
-    diff = _generate_diff(original, new_content, path)
+    # Generate diff — capped, and marked as truncated in the preview and the log
+    diff = _generate_diff(original, new_content, path, limit=3000)
 
     if not diff.strip():
         await _reply(update, "ℹ️ No changes needed — file already matches.")
         return
 
-    global pending_action
-    pending_action = {
+    sess.pending_action = {
         "type": "FILE_EDIT",
         "path": path,
         "original": original,
@@ -517,25 +930,22 @@ async def cmd_edit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     }
 
     if REQUIRE_APPROVAL:
-        preview = f"✏️ *Proposed edit to* `{os.path.basename(path)}`:\n\n```diff\n{diff[:3000]}\n```"
-        if len(diff) > 3000:
-            preview += "\n... (diff truncated)"
+        preview = f"✏️ *Proposed edit to* `{os.path.basename(path)}`:\n\n```diff\n{diff}\n```"
         preview += "\n\nReply ✅ to apply or ❌ to cancel."
         await _reply(update, preview)
     else:
         await _execute_pending_action(update)
 
 
+@with_autosave
 async def cmd_create(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle /create <path> <description> — AI-generated file."""
-    if not is_authorized(update):
-        return
-
     if not context.args or len(context.args) < 2:
         await _reply(update, "⚠️ Usage: `/create <path> <description of file>`")
         return
 
-    path = _resolve_path(context.args[0])
+    sess = _session_for(update)
+    path = _resolve_path(context.args[0], sess.project_dir)
     description = " ".join(context.args[1:])
 
     if os.path.exists(path):
@@ -556,11 +966,10 @@ async def cmd_create(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         f"or markdown code fences. Just the raw file content."
     )
 
-    content = await _ask_gemini(create_prompt)
+    content = await _ask_gemini(sess, create_prompt)
     content = _strip_code_fences(content)
 
-    global pending_action
-    pending_action = {
+    sess.pending_action = {
         "type": "FILE_CREATE",
         "path": path,
         "content": content,
@@ -577,23 +986,18 @@ async def cmd_create(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         await _execute_pending_action(update)
 
 
-async def cmd_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+@with_autosave
+@require_args("/task <describe what you want to build/fix>")
+async def cmd_task(update: Update, context: ContextTypes.DEFAULT_TYPE, description: str) -> None:
     """Handle /task <description> — multi-step agentic coding task."""
-    if not is_authorized(update):
-        return
-
-    if not context.args:
-        await _reply(update, "⚠️ Usage: `/task <describe what you want to build/fix>`")
-        return
-
-    description = " ".join(context.args)
+    sess = _session_for(update)
 
     await _reply(update, "🚀 Planning task...")
 
     # Get project context
     project_files = ""
     try:
-        entries = os.listdir(current_project_dir)[:30]
+        entries = os.listdir(sess.project_dir)[:30]
         project_files = "\n".join(f"  - {e}" for e in sorted(entries))
     except Exception:
         project_files = "(could not list directory)"
@@ -601,7 +1005,7 @@ async def cmd_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     plan_prompt = (
         f"I need you to plan a coding task. Here's the context:\n\n"
         f"**Task:** {description}\n"
-        f"**Working directory:** `{current_project_dir}`\n"
+        f"**Working directory:** `{sess.project_dir}`\n"
         f"**Files in project:**\n{project_files}\n\n"
         f"Create a step-by-step plan. For each step, indicate:\n"
         f"1. What action to take (create file, edit file, run command)\n"
@@ -611,10 +1015,9 @@ async def cmd_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         f"Format each step as: `STEP N: [ACTION] [target] — [description]`"
     )
 
-    plan = await _ask_gemini(plan_prompt)
+    plan = await _ask_gemini(sess, plan_prompt)
 
-    global pending_action
-    pending_action = {
+    sess.pending_action = {
         "type": "TASK_EXECUTE",
         "description": description,
         "plan": plan,
@@ -629,14 +1032,14 @@ async def cmd_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 # ── Pending Action Executor ──────────────────────────────────────────────────
 async def _execute_pending_action(update: Update) -> None:
     """Execute the pending approved action."""
-    global pending_action
+    sess = _session_for(update)
 
-    if not pending_action:
+    if not sess.pending_action:
         await _reply(update, "ℹ️ No pending action to approve.")
         return
 
-    action = pending_action
-    pending_action = None
+    action = sess.pending_action
+    sess.pending_action = None
     action_type = action["type"]
 
     if action_type == "FILE_EDIT":
@@ -644,22 +1047,19 @@ async def _execute_pending_action(update: Update) -> None:
         try:
             # Create backup
             backup_path = path + ".bak"
-            with open(path, "r") as f:
-                original = f.read()
-            with open(backup_path, "w") as f:
-                f.write(original)
+            original = await asyncio.to_thread(_read_file, path)
+            await asyncio.to_thread(_write_file, backup_path, original)
 
             # Write new content
-            with open(path, "w") as f:
-                f.write(action["new_content"])
+            await asyncio.to_thread(_write_file, path, action["new_content"])
 
-            _log_action("FILE_EDIT", {
+            _log_action(sess, "FILE_EDIT", {
                 "file": path,
                 "instructions": action["instructions"],
                 "diff": action["diff"],
                 "status": "✅ Applied",
             })
-            conversation_history.append({
+            _append_turn(sess, {
                 "role": "user", "text": f"✅ Approved edit to {path}",
                 "action": {
                     "type": "FILE_EDIT",
@@ -668,7 +1068,6 @@ async def _execute_pending_action(update: Update) -> None:
                     "status": "✅ Applied",
                 },
             })
-            _save_session()
 
             await _reply(update,
                 f"✅ *Edit applied* to `{os.path.basename(path)}`\n"
@@ -681,16 +1080,15 @@ async def _execute_pending_action(update: Update) -> None:
         path = action["path"]
         try:
             os.makedirs(os.path.dirname(path), exist_ok=True)
-            with open(path, "w") as f:
-                f.write(action["content"])
+            await asyncio.to_thread(_write_file, path, action["content"])
 
-            _log_action("FILE_CREATE", {
+            _log_action(sess, "FILE_CREATE", {
                 "file": path,
                 "description": action["description"],
                 "content_preview": action["content"][:500],
                 "status": "✅ Created",
             })
-            conversation_history.append({
+            _append_turn(sess, {
                 "role": "user", "text": f"✅ Approved create {path}",
                 "action": {
                     "type": "FILE_CREATE",
@@ -698,7 +1096,6 @@ async def _execute_pending_action(update: Update) -> None:
                     "status": "✅ Created",
                 },
             })
-            _save_session()
 
             await _reply(update, f"✅ *Created* `{os.path.basename(path)}`")
         except Exception as e:
@@ -710,7 +1107,7 @@ async def _execute_pending_action(update: Update) -> None:
         exec_prompt = (
             f"Now execute this plan by providing the actual file contents and commands.\n\n"
             f"**Plan:**\n{action['plan']}\n\n"
-            f"**Working directory:** `{current_project_dir}`\n\n"
+            f"**Working directory:** `{sess.project_dir}`\n\n"
             f"For each step, provide the COMPLETE implementation. "
             f"Format your response as a series of blocks:\n\n"
             f"For file creates/edits, use:\n"
@@ -721,79 +1118,362 @@ async def _execute_pending_action(update: Update) -> None:
             f"Implement every step fully."
         )
 
-        result = await _ask_gemini(exec_prompt)
+        result = await _ask_gemini(sess, exec_prompt)
+        await _reply(update, result)
 
-        _log_action("TASK_EXECUTE", {
+        writes, commands, notes = _plan_task(result, sess.project_dir)
+        task = {
+            "type": "TASK_APPLY",
             "description": action["description"],
             "plan": action["plan"],
-            "result": result[:2000],
-            "status": "✅ Executed",
-        })
-        conversation_history.append({
-            "role": "user", "text": f"✅ Approved task: {action['description']}",
-            "action": {
-                "type": "TASK_EXECUTE",
-                "description": action["description"],
-                "status": "✅ Executed",
-            },
-        })
-        _save_session()
+            "result": result,
+            "writes": writes,
+            "commands": commands,
+            "notes": notes,
+        }
 
-        await _reply(update, result)
+        # Approving the plan isn't approving the files and commands it became
+        if REQUIRE_APPROVAL and (writes or commands):
+            sess.pending_action = task
+            steps = []
+            for path, body in writes.items():
+                lines = body.count("\n")
+                steps.append(f"📄 Write `{path}` ({lines} lines)")
+            steps.extend(f"⚡ Run `{command}`" for command in commands)
+            preview = "🚀 *Task changes:*\n\n" + "\n".join(steps)
+            if notes:
+                preview += "\n\n⚠️ *Skipped:*\n" + "\n".join(notes)
+            preview += "\n\nReply ✅ to apply or ❌ to cancel."
+            await _reply(update, preview)
+        else:
+            await _apply_task(update, sess, task)
+
+    elif action_type == "TASK_APPLY":
+        await _apply_task(update, sess, action)
+
+
+async def _apply_task(update: Update, sess: Session, task: dict) -> None:
+    """Write a task's files, then run its commands in order."""
+    writes, commands, notes = task["writes"], task["commands"], task["notes"]
+    problems = []
+
+    # Each path is written once, so the writes can't race; run them concurrently
+    outcomes = await asyncio.gather(
+        *(asyncio.to_thread(_write_task_file, path, body) for path, body in writes.items()),
+        return_exceptions=True,
+    )
+    summary = []
+    for path, outcome in zip(writes, outcomes):
+        if isinstance(outcome, Exception):
+            summary.append(f"❌ `{path}`: {outcome}")
+        else:
+            summary.append(f"✅ Wrote `{path}`")
+    failed = sum(isinstance(outcome, Exception) for outcome in outcomes)
+    if failed:
+        problems.append(f"{failed} file write(s) failed")
+    if summary:
+        await _reply(update, "📂 *Files:*\n" + "\n".join(summary))
+
+    # Commands may depend on the files and on each other, so run in order
+    for i, command in enumerate(commands):
+        exit_code = await _execute_and_reply(update, command)
+        if exit_code != 0:
+            skipped = len(commands) - i - 1
+            outcome = f"exited {exit_code}" if exit_code is not None else "didn't run"
+            problems.append(f"`{command}` {outcome}, {skipped} command(s) skipped")
+            if skipped:
+                await _reply(update, "⚠️ Stopping — remaining commands skipped.")
+            break
+
+    if notes:
+        problems.append(f"{len(notes)} block(s) skipped")
+        await _reply(update, "⚠️ *Skipped blocks:*\n" + "\n".join(notes))
+
+    status = "⚠️ " + "; ".join(problems) if problems else "✅ Executed"
+    files = list(writes)
+    _log_action(sess, "TASK_EXECUTE", {
+        "description": task["description"],
+        "plan": task["plan"],
+        "result": task["result"][:2000],
+        "files": files,
+        "commands": commands,
+        "status": status,
+    })
+    _append_turn(sess, {
+        "role": "user", "text": f"✅ Approved task: {task['description']}",
+        "action": {
+            "type": "TASK_EXECUTE",
+            "description": task["description"],
+            "files": ", ".join(files) or "(none)",
+            "commands": ", ".join(commands) or "(none)",
+            "status": status,
+        },
+    })
+
+    if problems:
+        await _reply(update,
+            "\n⚠️ *Task finished with problems:*\n" + "\n".join(f"• {p}" for p in problems) +
+            "\nResults logged for IDE continuity."
+        )
+    else:
         await _reply(update,
             "\n📝 *Task complete.* Results logged for IDE continuity.\n"
             "Use `/view`, `/edit`, or `/run` to follow up on individual steps."
         )
 
 
+# ── Task Blocks ──────────────────────────────────────────────────────────────
+_TASK_TAG_RE = re.compile(r"^[*_#\s]*(FILE|RUN)[*_]*:[*_]*\s*(.+)$")
+# Looser form, only used to report tags the parser won't act on
+_TASK_TAG_LOOSE_RE = re.compile(r"^[*_#\s]*(?:\d+[.)]|[-+])?[\s*_]*(?:FILE|RUN)[*_]*:[*_]*\s*(.*)$")
+
+
+_FENCE_LINE_RE = re.compile(r"^(`{3,})(.*)$")
+
+
+def _parse_task_blocks(text: str) -> tuple[list[tuple[str, str, str]], list[str]]:
+    """Parse ``FILE:``/``RUN:`` blocks from a task result, in order.
+
+    Returns ``(blocks, dropped)``. Blocks are ``(kind, target, body)``
+    tuples; ``body`` is the fenced file contents for FILE blocks and empty
+    for RUN blocks. Fences nested in a file body are kept. ``dropped`` has a
+    note for each tag that was skipped — a FILE block with no code block or
+    one whose fence never closes, or a tag line in a form that isn't parsed.
+    """
+    blocks = []
+    dropped = []
+    file_target = None
+    body = None
+    open_len = depth = 0  # Opening fence length, and nested fences inside it
+    for line in text.split("\n"):
+        stripped = line.strip()
+        if body is not None:
+            m = _FENCE_LINE_RE.match(stripped)
+            # Shorter fences can't close the block, so they're plain content
+            if m and len(m.group(1)) >= open_len:
+                if m.group(2).strip():
+                    depth += 1  # Info string, e.g. ```bash — a nested block opens
+                elif depth:
+                    depth -= 1
+                else:
+                    blocks.append(("FILE", file_target, "\n".join(body) + "\n"))
+                    file_target = body = None
+                    continue
+            body.append(line)
+        elif file_target is not None and stripped.startswith("```"):
+            body = []
+            open_len = len(_FENCE_LINE_RE.match(stripped).group(1))
+            depth = 0
+        else:
+            m = _TASK_TAG_RE.match(stripped)
+            if not m:
+                loose = _TASK_TAG_LOOSE_RE.match(stripped)
+                if loose:
+                    reason = "nothing after the colon" if not loose.group(1) else "list markers aren't parsed"
+                    dropped.append(f"`{stripped[:80]}` — {reason}")
+                continue
+            if file_target is not None:
+                dropped.append(f"FILE `{file_target}` — no code block")
+            target = m.group(2).strip().strip("`*").strip()
+            if m.group(1) == "FILE":
+                file_target = target
+            else:
+                file_target = None
+                blocks.append(("RUN", target, ""))
+    if body is not None:
+        dropped.append(f"FILE `{file_target}` — code block never closed")
+    elif file_target is not None:
+        dropped.append(f"FILE `{file_target}` — no code block")
+    return blocks, dropped
+
+
+def _plan_task(text: str, base_dir: str) -> tuple[dict[str, str], list[str], list[str]]:
+    """Turn a task result into ``(writes, commands, notes)``.
+
+    ``writes`` maps each resolved path to the last FILE block for it, so a
+    file Gemini repeats (``f.txt`` and ``./f.txt``) is written, and backed
+    up from the original, exactly once. ``notes`` says which blocks were
+    dropped or superseded.
+    """
+    blocks, notes = _parse_task_blocks(text)
+    writes = {}
+    commands = []
+    for kind, target, body in blocks:
+        if kind == "RUN":
+            commands.append(target)
+            continue
+        path = _resolve_path(target, base_dir)
+        if path in writes:
+            notes.append(f"FILE `{target}` — repeats `{path}`; only the last version is written")
+        writes[path] = body
+    return writes, commands, notes
+
+
+def _write_task_file(path: str, content: str) -> None:
+    """Blocking write for a task FILE block, keeping a .bak of any existing file."""
+    if os.path.exists(path):
+        shutil.copyfile(path, path + ".bak")
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    _write_file(path, content)
+
+
 # ── Utility Functions ────────────────────────────────────────────────────────
+def _read_file(path: str) -> str:
+    """Blocking text read — call through asyncio.to_thread."""
+    with open(path, "r") as f:
+        return f.read()
+
+
+def _read_bytes(path: str) -> bytes:
+    """Blocking binary read — call through asyncio.to_thread."""
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _write_file(path: str, content: str) -> None:
+    """Blocking text write — call through asyncio.to_thread."""
+    with open(path, "w") as f:
+        f.write(content)
+
+
 def _strip_code_fences(text: str) -> str:
     """Remove markdown code fences from Gemini output."""
-    text = text.strip()
-    if text.startswith("```"):
+    # Work with indices so a large response is only copied once, at the end
+    start, end = 0, len(text)
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    if text.startswith("```", start, end):
         # Remove first line (```language)
-        first_nl = text.find("\n")
+        first_nl = text.find("\n", start, end)
         if first_nl != -1:
-            text = text[first_nl + 1:]
-    if text.endswith("```"):
-        text = text[:-3].rstrip()
-    return text
+            start = first_nl + 1
+    if text.endswith("```", start, end):
+        end -= 3
+        while end > start and text[end - 1].isspace():
+            end -= 1
+    return text[start:end]
+
+
+_UNITS = ("B", "KB", "MB", "GB")
+
+
+def _fmt_size(n: int) -> str:
+    """Format a byte count with a binary unit, e.g. 2048 -> "2KB"."""
+    i = min(max(0, (n.bit_length() - 1) // 10), len(_UNITS) - 1)
+    return f"{n >> (i * 10)}{_UNITS[i]}"
 
 
-def _generate_diff(original: str, new: str, filename: str) -> str:
-    """Generate a unified diff between two strings."""
-    orig_lines = original.splitlines(keepends=True)
-    new_lines = new.splitlines(keepends=True)
+_DIFF_TRUNCATED = "\n... (diff truncated)"
+
+
+def _generate_diff(original: str, new: str, filename: str, limit: int = None) -> str:
+    """Generate a unified diff between two strings.
+
+    If ``limit`` is given, stop at the last whole line that fits in that
+    many characters, so huge edits are never fully materialized, and end
+    the diff with ``_DIFF_TRUNCATED`` so readers know it's incomplete.
+    """
     diff = difflib.unified_diff(
-        orig_lines, new_lines,
+        original.splitlines(), new.splitlines(),
         fromfile=f"a/{os.path.basename(filename)}",
         tofile=f"b/{os.path.basename(filename)}",
         lineterm="",
     )
-    return "\n".join(diff)
+    buf = io.StringIO()
+    for line in diff:
+        if limit is not None and buf.tell() + len(line) + 1 > limit:
+            buf.write(_DIFF_TRUNCATED)
+            break
+        if buf.tell():
+            buf.write("\n")
+        buf.write(line)
+    return buf.getvalue()
+
+
+_HUNK_RE = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+\d+(?:,\d+)? @@")
+
+
+def _parse_hunks(patch: str) -> list[tuple[int, list[str], list[str]]]:
+    """Parse a unified diff into ``(start_index, old_lines, new_lines)`` hunks."""
+    hunks = []
+    old = new = None
+    for line in patch.split("\n"):
+        m = _HUNK_RE.match(line)
+        if m:
+            start = int(m.group(1))
+            # A pure insertion (",0") goes after line `start`, not at it
+            index = start if m.group(2) == "0" else max(start - 1, 0)
+            old, new = [], []
+            hunks.append((index, old, new))
+        elif old is None or line.startswith("\\"):
+            continue  # File headers, or "\ No newline at end of file"
+        elif line.startswith("+"):
+            new.append(line[1:])
+        elif line.startswith("-"):
+            old.append(line[1:])
+        elif line.startswith(" ") or not line:
+            old.append(line[1:])
+            new.append(line[1:])
+        else:
+            return []
+    return hunks
+
+
+def _find_block(lines: list[str], block: list[str], hint: int, lo: int) -> int:
+    """Find ``block`` in ``lines`` at or after ``lo``, searching outward from ``hint``."""
+    if not block:
+        return min(max(hint, lo), len(lines))
+    last = len(lines) - len(block)
+    for d in range(len(lines) + 1):
+        below, above = hint - d, hint + d
+        if below < lo and above > last:
+            break
+        for pos in (below, above):
+            if lo <= pos <= last and lines[pos:pos + len(block)] == block:
+                return pos
+    return None
+
+
+def _apply_unified_diff(original: str, patch: str) -> str:
+    """Apply a unified diff to ``original``; return None if it doesn't apply."""
+    hunks = _parse_hunks(patch)
+    if not hunks:
+        return None
+
+    lines = original.split("\n")
+    result = []
+    cursor = 0
+    for index, old, new in hunks:
+        pos = _find_block(lines, old, index, cursor)
+        if pos is None:
+            return None
+        result.extend(lines[cursor:pos])
+        result.extend(new)
+        cursor = pos + len(old)
+    result.extend(lines[cursor:])
+    return "\n".join(result)
 
 
 # ── Mac Control Commands ─────────────────────────────────────────────────────
 async def cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not is_authorized(update):
-        return
-
-    try:
-        uptime = subprocess.run(
-            ["uptime"], capture_output=True, text=True, timeout=5
-        ).stdout.strip()
-        battery = subprocess.run(
-            ["pmset", "-g", "batt"], capture_output=True, text=True, timeout=5
-        ).stdout.strip()
-        hostname = subprocess.run(
-            ["hostname"], capture_output=True, text=True, timeout=5
-        ).stdout.strip()
-    except Exception as e:
-        uptime = battery = hostname = f"(error: {e})"
+    # One failing probe (e.g. no pmset) shouldn't hide the others
+    uptime, battery, hostname = (
+        f"(error: {r!r})" if isinstance(r, Exception) else r
+        for r in await asyncio.gather(
+            _probe("uptime"),
+            _probe("pmset", "-g", "batt"),
+            _probe("hostname"),
+            return_exceptions=True,
+        )
+    )
 
+    sess = _sessions.get(update.effective_chat.id)
     session_info = (
-        f"📝 Session: `{session_start_time}`"
-        if session_start_time
+        f"📝 Session: `{sess.start_time}`"
+        if sess is not None
         else "📝 No active session"
     )
 
@@ -802,49 +1482,48 @@ async def cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         f"🖥 `{hostname}`\n"
         f"⏱ {uptime}\n"
         f"🔋 {battery}\n\n"
-        f"📁 Project: `{current_project_dir}`\n"
+        f"📁 Project: `{sess.project_dir if sess is not None else PROJECT_DIR}`\n"
         f"{session_info}"
     )
 
 
-async def cmd_run(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not is_authorized(update):
-        return
-
-    command = " ".join(context.args) if context.args else ""
-    if not command:
-        await _reply(update, "⚠️ Usage: `/run <command>`")
-        return
-
+@with_autosave
+@require_args("/run <command>")
+async def cmd_run(update: Update, context: ContextTypes.DEFAULT_TYPE, command: str) -> None:
     await _execute_and_reply(update, command)
 
 
-async def cmd_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not is_authorized(update):
-        return
-
-    path = " ".join(context.args) if context.args else ""
-    if not path:
-        await _reply(update, "⚠️ Usage: `/file <path>`")
-        return
+@require_args("/file <path>")
+async def cmd_file(update: Update, context: ContextTypes.DEFAULT_TYPE, path: str) -> None:
+    path = _resolve_path(path, _session_for(update).project_dir)
 
-    path = _resolve_path(path)
-
-    if not os.path.exists(path):
+    # One stat() answers exists/is-dir/size
+    try:
+        st = await asyncio.to_thread(os.stat, path)
+    except (FileNotFoundError, NotADirectoryError):
         await _reply(update, f"❌ File not found: `{path}`")
         return
+    except OSError as e:
+        await _reply(update, f"❌ Can't access `{path}`: {e.strerror}")
+        return
 
-    if os.path.isdir(path):
+    if stat.S_ISDIR(st.st_mode):
         await _reply(update, "❌ That's a directory. Use `/ls` instead.")
         return
 
-    size_mb = os.path.getsize(path) / (1024 * 1024)
+    size_mb = st.st_size / (1024 * 1024)
     if size_mb > 50:
         await _reply(update, f"❌ File too large ({size_mb:.1f} MB). Telegram limit is 50 MB.")
         return
 
+    # Read in a thread so the file is closed and the loop never blocks on disk
+    try:
+        data = await asyncio.to_thread(_read_bytes, path)
+    except OSError as e:
+        await _reply(update, f"❌ Can't read `{path}`: {e.strerror}")
+        return
     await update.message.reply_document(
-        document=open(path, "rb"),
+        document=data,
         filename=os.path.basename(path),
         caption=f"📁 `{path}`",
         parse_mode="Markdown",
@@ -852,50 +1531,106 @@ async def cmd_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 
 async def cmd_screen(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not is_authorized(update):
-        return
-
     await _reply(update, "📸 Taking screenshot...")
 
     try:
-        subprocess.run(
-            ["screencapture", "-x", SCREENSHOT_PATH],
-            timeout=10, check=True,
+        # Capture straight into memory; no temp file to write, read and clean up
+        proc = await asyncio.create_subprocess_exec(
+            "screencapture", "-x", "-t", "png", "/dev/stdout",
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
         )
-        if os.path.exists(SCREENSHOT_PATH):
-            await update.message.reply_photo(
-                photo=open(SCREENSHOT_PATH, "rb"),
-                caption="🖥 Screenshot",
-            )
-            os.remove(SCREENSHOT_PATH)
-        else:
+        photo, _ = await _communicate(proc, 10)
+
+        if proc.returncode != 0 or not photo.startswith(_PNG_MAGIC):
+            # Older screencapture can't write to a pipe — go through a file
+            photo = await _screenshot_via_file()
+
+        if photo is None:
             await _reply(update, "❌ Screenshot failed.")
-    except subprocess.TimeoutExpired:
+        else:
+            await update.message.reply_photo(photo=photo, caption="🖥 Screenshot")
+    except asyncio.TimeoutError:
         await _reply(update, "❌ Screenshot timed out.")
     except Exception as e:
         await _reply(update, f"❌ Screenshot error: `{e}`")
 
 
+_PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+
+
+async def _screenshot_via_file() -> bytes:
+    """Fallback capture through SCREENSHOT_PATH; returns None on failure."""
+    proc = await asyncio.create_subprocess_exec(
+        "screencapture", "-x", SCREENSHOT_PATH,
+    )
+    await _communicate(proc, 10)
+    if proc.returncode != 0 or not os.path.exists(SCREENSHOT_PATH):
+        return None
+    photo = await asyncio.to_thread(_read_bytes, SCREENSHOT_PATH)
+    await asyncio.to_thread(os.remove, SCREENSHOT_PATH)
+    return photo
+
+
 # ── Shell Execution Helper ───────────────────────────────────────────────────
-async def _execute_and_reply(update: Update, command: str) -> None:
+async def _communicate(
+    proc: asyncio.subprocess.Process, timeout: float, group: bool = False,
+) -> tuple[bytes, bytes]:
+    """Wait for a subprocess without blocking the event loop; kill it on timeout.
+
+    With ``group``, the whole process group is killed — use it for processes
+    started with ``start_new_session=True`` so a shell's children die too.
+    """
+    try:
+        return await asyncio.wait_for(proc.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        try:
+            if group:
+                os.killpg(proc.pid, signal.SIGKILL)
+            else:
+                proc.kill()
+        except ProcessLookupError:
+            pass  # Already exited
+        await proc.wait()
+        raise
+
+
+async def _probe(*cmd: str) -> str:
+    """Run a quick status command and return its stripped stdout."""
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+    )
+    stdout, _ = await _communicate(proc, 5)
+    return stdout.decode(errors="replace").strip()
+
+
+async def _execute_and_reply(update: Update, command: str) -> int:
+    """Run a shell command and reply with its output.
+
+    Returns the exit code, or None if the command was blocked or failed to run.
+    """
     if is_blocked(command):
         await _reply(update,
             f"🚫 *Blocked* — safety blocklist:\n`{command}`"
         )
-        return
+        return None
 
-    logger.info(f"Executing: {command}")
+    sess = _session_for(update)
+    logger.info("Executing: %s", command)
     await _reply(update, f"⏳ Running: `{html.escape(command)}`", parse_mode="HTML")
 
     try:
-        result = subprocess.run(
-            command, shell=True, capture_output=True, text=True,
-            timeout=COMMAND_TIMEOUT, cwd=current_project_dir,
+        proc = await asyncio.create_subprocess_shell(
+            command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=sess.project_dir,
+            start_new_session=True,
         )
+        out, err = await _communicate(proc, COMMAND_TIMEOUT, group=True)
 
-        stdout = result.stdout.strip()
-        stderr = result.stderr.strip()
-        exit_code = result.returncode
+        stdout = out.decode(errors="replace").strip()
+        stderr = err.decode(errors="replace").strip()
+        exit_code = proc.returncode
 
         parts = []
         if exit_code == 0:
@@ -925,74 +1660,107 @@ async def _execute_and_reply(update: Update, command: str) -> None:
             "exit_code": exit_code,
             "output": (stdout or stderr or "(no output)")[:500],
         }
-        _log_action("COMMAND_RUN", action)
-        conversation_history.append({
+        _log_action(sess, "COMMAND_RUN", action)
+        _append_turn(sess, {
             "role": "user", "text": f"/run {command}",
             "action": action,
         })
-        _save_session()
 
         await _reply(update, response)
+        return exit_code
 
-    except subprocess.TimeoutExpired:
+    except asyncio.TimeoutError:
         await _reply(update, f"⏰ *Timed out* after {COMMAND_TIMEOUT}s:\n`{command}`")
     except Exception as e:
         await _reply(update, f"❌ *Error:*\n`{e}`")
+    return None
 
 
 # ── Main ─────────────────────────────────────────────────────────────────────
-def main() -> None:
-    if not TELEGRAM_BOT_TOKEN:
-        print("❌ ERROR: Set TELEGRAM_BOT_TOKEN in config.py first!")
-        sys.exit(1)
+async def _on_startup(app: Application) -> None:
+    """Size the default executor that asyncio.to_thread file I/O runs on."""
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=32, thread_name_prefix="anti-bot-io")
+    )
 
-    if not ALLOWED_CHAT_ID:
-        print("❌ ERROR: Set ALLOWED_CHAT_ID in config.py first!")
-        sys.exit(1)
 
-    if not GEMINI_API_KEY:
-        print("❌ ERROR: Set GEMINI_API_KEY in config.py or env!")
+async def _on_shutdown(app: Application) -> None:
+    """Flush buffered turns and render every chat's transcript before exiting."""
+    for sess in list(_sessions.values()):
+        await _save_and_render(sess)
+
+
+# Settings the bot can't start without
+_REQUIRED_CONFIG = {
+    "TELEGRAM_BOT_TOKEN": TELEGRAM_BOT_TOKEN,
+    "ALLOWED_CHAT_ID": ALLOWED_CHAT_ID,
+    "GEMINI_API_KEY": GEMINI_API_KEY,
+}
+
+
+def main() -> None:
+    missing = [name for name, value in _REQUIRED_CONFIG.items() if not value]
+    if missing:
+        print(f"❌ ERROR: Set {', '.join(missing)} in config.py first!")
         sys.exit(1)
 
     _ensure_sessions_dir()
-    _start_new_session()
 
     print("🤖 anti-bot v2 starting (Antigravity Bridge)...")
     print(f"   Authorized chat ID: {ALLOWED_CHAT_ID}")
     print(f"   Gemini model: {GEMINI_MODEL}")
-    print(f"   Project dir: {current_project_dir}")
+    print(f"   Project dir: {PROJECT_DIR}")
     print(f"   Sessions dir: {SESSIONS_DIR}")
     print("   Waiting for commands...")
 
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    # Handle updates concurrently so a slow command doesn't stall other chats
+    app = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(True)
+        .post_init(_on_startup)
+        .post_shutdown(_on_shutdown)
+        .build()
+    )
+
+    # Authorization gate — runs first and drops updates from other chats, so
+    # the handlers below don't check again
+    app.add_handler(TypeHandler(Update, _reject_unauthorized), group=-1)
 
     # AI chat
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("help", cmd_help))
-    app.add_handler(CommandHandler("ask", cmd_ask))
+    app.add_handler(CommandHandler("ask", cmd_ask, block=False))
     app.add_handler(CommandHandler("clear", cmd_clear))
     app.add_handler(CommandHandler("history", cmd_history))
 
     # File operations
     app.add_handler(CommandHandler("view", cmd_view))
-    app.add_handler(CommandHandler("edit", cmd_edit))
-    app.add_handler(CommandHandler("create", cmd_create))
+    app.add_handler(CommandHandler("edit", cmd_edit, block=False))
+    app.add_handler(CommandHandler("create", cmd_create, block=False))
     app.add_handler(CommandHandler("ls", cmd_ls))
     app.add_handler(CommandHandler("project", cmd_project))
 
     # Agentic tasks
-    app.add_handler(CommandHandler("task", cmd_task))
+    app.add_handler(CommandHandler("task", cmd_task, block=False))
 
     # Mac control
     app.add_handler(CommandHandler("status", cmd_status))
-    app.add_handler(CommandHandler("run", cmd_run))
+    app.add_handler(CommandHandler("run", cmd_run, block=False))
     app.add_handler(CommandHandler("file", cmd_file))
-    app.add_handler(CommandHandler("screen", cmd_screen))
+    app.add_handler(CommandHandler("screen", cmd_screen, block=False))
 
     # Plain text → AI chat (or approval handler)
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
-
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text, block=False))
+
+    # Long polling: Telegram holds each getUpdates open for up to 30s when
+    # idle. Only messages are handled, so let the server filter the rest.
+    app.run_polling(
+        timeout=30,
+        poll_interval=0.0,
+        bootstrap_retries=-1,
+        allowed_updates=[Update.MESSAGE],
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,16 @@
+"""Make ``bot`` importable from a fresh checkout, before config.py exists."""
+
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+if importlib.util.find_spec("config") is None:
+    spec = importlib.util.spec_from_file_location(
+        "config", os.path.join(ROOT, "config.example.py")
+    )
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+    sys.modules["config"] = config
@@ -0,0 +1,86 @@
+"""Tests for applying Gemini's unified diffs in /edit."""
+
+import difflib
+import random
+
+import pytest
+
+from bot import _apply_unified_diff, _generate_diff
+
+
+def _diff(a: str, b: str, n: int = 3) -> str:
+    return "\n".join(difflib.unified_diff(
+        a.split("\n"), b.split("\n"), "a/f", "b/f", n=n, lineterm="",
+    ))
+
+
+def _mutate(rng: random.Random, lines: list[str]) -> list[str]:
+    out = list(lines)
+    for _ in range(rng.randint(1, 6)):
+        op = rng.choice(("insert", "delete", "replace"))
+        i = rng.randrange(len(out) + 1)
+        if op == "insert" or not out:
+            out[i:i] = [f"new {rng.random():.6f}" for _ in range(rng.randint(1, 3))]
+        elif op == "delete":
+            del out[min(i, len(out) - 1)]
+        else:
+            out[min(i, len(out) - 1)] = f"changed {rng.random():.6f}"
+    return out
+
+
+@pytest.mark.parametrize("n", [0, 1, 3])
+def test_round_trips_difflib_output(n):
+    rng = random.Random(n)
+    for _ in range(300):
+        # A small alphabet repeats lines, so hunks must be placed by position
+        lines = [rng.choice("abcdef") * rng.randint(0, 3) for _ in range(rng.randint(1, 40))]
+        original = "\n".join(lines)
+        new = "\n".join(_mutate(rng, lines))
+        assert _apply_unified_diff(original, _diff(original, new, n)) == new
+
+
+def test_round_trips_generate_diff():
+    original = "\n".join(f"line {i}" for i in range(100))
+    new = original.replace("line 10\n", "line ten\n").replace("line 90", "line 90\nextra")
+    assert _apply_unified_diff(original, _generate_diff(original, new, "f.py")) == new
+
+
+def test_pure_insertion_goes_after_the_named_line():
+    patch = "@@ -2,0 +3 @@\n+X"
+    assert _apply_unified_diff("a\nb\nc", patch) == "a\nb\nX\nc"
+
+
+def test_pure_insertion_at_top_of_file():
+    patch = "@@ -0,0 +1,2 @@\n+X\n+Y"
+    assert _apply_unified_diff("a\nb", patch) == "X\nY\na\nb"
+
+
+def test_hunk_with_stale_line_numbers_still_applies():
+    original = "\n".join(f"line {i}" for i in range(50))
+    patch = "@@ -5,3 +5,3 @@\n line 29\n-line 30\n+line thirty\n line 31"
+    assert _apply_unified_diff(original, patch) == original.replace("line 30", "line thirty")
+
+
+def test_hunk_that_does_not_match_is_rejected():
+    patch = "@@ -1,2 +1,2 @@\n a\n-zzz\n+yyy"
+    assert _apply_unified_diff("a\nb\nc", patch) is None
+
+
+def test_text_without_hunks_is_rejected():
+    assert _apply_unified_diff("a\nb", "Sure! Here is the updated file:\na\nB") is None
+
+
+def test_hunks_apply_in_order():
+    # The second hunk's context also appears before the first; it must not match there
+    original = "x\nkeep\nx\nkeep"
+    patch = "@@ -1,2 +1,2 @@\n-x\n+1\n keep\n@@ -3,2 +3,2 @@\n-x\n+2\n keep"
+    assert _apply_unified_diff(original, patch) == "1\nkeep\n2\nkeep"
+
+
+def test_generate_diff_marks_truncation():
+    original = "\n".join(f"line {i}" for i in range(1000))
+    new = original.replace("line", "LINE")
+    diff = _generate_diff(original, new, "f.py", limit=500)
+    assert len(diff) <= 500 + len("\n... (diff truncated)")
+    assert diff.endswith("\n... (diff truncated)")
+    assert not _generate_diff("a", "b", "f.py", limit=500).endswith("(diff truncated)")
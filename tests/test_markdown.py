@@ -0,0 +1,97 @@
+"""Tests for splitting replies and checking their Markdown before sending."""
+
+import random
+import re
+
+import pytest
+
+from bot import _markdown_ok, _split_markdown
+
+
+def _fence_lines(chunk: str) -> int:
+    return sum(1 for line in chunk.split("\n") if line.strip().startswith("```"))
+
+
+def _text_only(text: str) -> str:
+    """Everything but fence lines and whitespace, which splitting may add."""
+    lines = [line for line in text.split("\n") if not line.strip().startswith("```")]
+    return re.sub(r"\s+", "", "".join(lines))
+
+
+def _random_reply(rng: random.Random) -> str:
+    parts = []
+    for _ in range(rng.randint(1, 30)):
+        if rng.random() < 0.3:
+            body = "\n".join(
+                "x" * rng.randint(0, 120) for _ in range(rng.randint(0, 40))
+            )
+            parts.append(f"```{rng.choice(['', 'python', 'bash'])}\n{body}\n```")
+        else:
+            words = rng.randint(1, 200)
+            parts.append(" ".join(rng.choice(["word", "*b*", "longer-word"]) for _ in range(words)))
+    return "\n\n".join(parts)
+
+
+def test_short_text_is_one_chunk():
+    assert _split_markdown("hello", limit=100) == ["hello"]
+
+
+@pytest.mark.parametrize("limit", [60, 200, 4096])
+def test_chunks_fit_and_keep_fences_balanced(limit):
+    rng = random.Random(limit)
+    for _ in range(200):
+        text = _random_reply(rng)
+        chunks = _split_markdown(text, limit=limit)
+        for chunk in chunks:
+            assert 0 < len(chunk) <= limit
+            assert chunk.strip()
+            assert _fence_lines(chunk) % 2 == 0
+        assert _text_only("\n".join(chunks)) == _text_only(text)
+
+
+def test_reopened_fence_keeps_its_language():
+    code = "\n".join(f"print({i})" for i in range(100))
+    chunks = _split_markdown(f"Intro\n\n```python\n{code}\n```", limit=300)
+    assert len(chunks) > 2
+    assert all(c.startswith("```python") for c in chunks[2:])
+
+
+def test_cuts_prefer_paragraph_breaks():
+    paras = ["a" * 40, "b" * 40, "c" * 40]
+    assert _split_markdown("\n\n".join(paras), limit=90) == [
+        "a" * 40 + "\n\n" + "b" * 40 + "\n",
+        "c" * 40,
+    ]
+
+
+@pytest.mark.parametrize("text", [
+    "plain text",
+    "*bold* and _italic_ and `code`",
+    "```\nsnake_case * and `ticks`\n```",
+    "`snake_case`",
+    "escaped \\_ and \\*",
+    "[link](https://example.com)",
+    "*Exit code: 1*\n\n```\nfoo\n```",
+])
+def test_markdown_ok_accepts_valid(text):
+    assert _markdown_ok(text)
+
+
+@pytest.mark.parametrize("text", [
+    "snake_case",
+    "2 * 3",
+    "unclosed `code",
+    "```\nnever closed",
+    "[oops",
+    "[text](https://example.com",
+])
+def test_markdown_ok_rejects_invalid(text):
+    assert not _markdown_ok(text)
+
+
+def test_long_line_is_not_broken_within_a_chunk():
+    # Cut into two pieces to fit, but both land in the same chunk
+    line = "x" * 150
+    chunks = _split_markdown(f"```\n{'y' * 100}\n{line}\n```", limit=200)
+    assert len(chunks) == 2
+    assert chunks[1] == f"```\n{line}\n```"
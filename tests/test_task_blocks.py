@@ -0,0 +1,88 @@
+"""Tests for parsing and planning /task FILE: and RUN: blocks."""
+
+import os
+
+from bot import _parse_task_blocks, _plan_task, _write_task_file
+
+
+def test_file_and_run_blocks_in_order():
+    text = "Plan done.\nFILE: a.py\n```python\nprint(1)\n```\nRUN: python a.py\n"
+    blocks, dropped = _parse_task_blocks(text)
+    assert blocks == [("FILE", "a.py", "print(1)\n"), ("RUN", "python a.py", "")]
+    assert dropped == []
+
+
+def test_decorated_tags_are_parsed():
+    text = "**FILE:** `a.txt`\n```\nx\n```\n### RUN: `ls -la`"
+    blocks, _ = _parse_task_blocks(text)
+    assert blocks == [("FILE", "a.txt", "x\n"), ("RUN", "ls -la", "")]
+
+
+def test_nested_fence_stays_in_file_body():
+    text = (
+        "FILE: README.md\n```markdown\n# T\n```bash\nnpm i\n```\nmore\n```\n"
+        "RUN: ls\n"
+    )
+    blocks, dropped = _parse_task_blocks(text)
+    assert blocks == [
+        ("FILE", "README.md", "# T\n```bash\nnpm i\n```\nmore\n"),
+        ("RUN", "ls", ""),
+    ]
+    assert dropped == []
+
+
+def test_shorter_fence_does_not_close_longer_one():
+    text = "FILE: doc.md\n````\na\n```\nb\n````\n"
+    blocks, _ = _parse_task_blocks(text)
+    assert blocks == [("FILE", "doc.md", "a\n```\nb\n")]
+
+
+def test_unclosed_fence_is_dropped_not_truncated():
+    text = "FILE: a.py\n```\nprint(1)\n```python\nnever closed\n"
+    blocks, dropped = _parse_task_blocks(text)
+    assert blocks == []
+    assert dropped == ["FILE `a.py` — code block never closed"]
+
+
+def test_file_without_code_block_is_reported():
+    blocks, dropped = _parse_task_blocks("FILE: a.py\nRUN: ls\n")
+    assert blocks == [("RUN", "ls", "")]
+    assert dropped == ["FILE `a.py` — no code block"]
+
+
+def test_unparsed_tag_forms_are_reported():
+    text = "1. FILE: x.py\nRUN:\n```bash\nnpm i\n```\n- RUN: make\n"
+    blocks, dropped = _parse_task_blocks(text)
+    assert blocks == []
+    assert dropped == [
+        "`1. FILE: x.py` — list markers aren't parsed",
+        "`RUN:` — nothing after the colon",
+        "`- RUN: make` — list markers aren't parsed",
+    ]
+
+
+def test_duplicate_paths_keep_last_block(tmp_path):
+    text = "FILE: f.txt\n```\none\n```\nFILE: ./f.txt\n```\ntwo\n```\nRUN: cat f.txt\n"
+    writes, commands, notes = _plan_task(text, str(tmp_path))
+    path = str(tmp_path / "f.txt")
+    assert writes == {path: "two\n"}
+    assert commands == ["cat f.txt"]
+    assert len(notes) == 1 and "./f.txt" in notes[0]
+
+
+def test_planned_writes_back_up_the_original_once(tmp_path):
+    target = tmp_path / "f.txt"
+    target.write_text("ORIGINAL\n")
+    text = "FILE: f.txt\n```\none\n```\nFILE: ./f.txt\n```\ntwo\n```\n"
+    writes, _, _ = _plan_task(text, str(tmp_path))
+    for path, body in writes.items():
+        _write_task_file(path, body)
+    assert target.read_text() == "two\n"
+    assert (tmp_path / "f.txt.bak").read_text() == "ORIGINAL\n"
+
+
+def test_write_creates_missing_directories(tmp_path):
+    path = os.path.join(tmp_path, "a", "b", "c.txt")
+    _write_task_file(path, "x\n")
+    with open(path) as f:
+        assert f.read() == "x\n"